@@ -1,88 +1,381 @@
+import asyncio
 import os
 import pathlib
+import pickle
+import threading
+import time
 from argparse import ArgumentParser
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
 
 from rich import print
 from rich.live import Live
+from rich.progress import Progress
 
 from . import recode, ui
 
-IGNORED_GLOBS = [".localized"]
+# Plain file names, a set lookup is all these need rather than glob matching
+IGNORED_NAMES = frozenset({".localized"})
 
-TO_RECODE = [".ape", ".flac", ".m4a", ".mp4"]
-TO_SKIP = [
+TO_RECODE = frozenset({".ape", ".flac", ".m4a", ".mp4"})
+TO_SKIP = frozenset({
     ".jpg", ".png", ".log", ".pdf", ".txt", ".ffp", ".md5", ".m3u", ".nfo",
     ".!qb", ".jpeg", ".accurip", ".db", ".html", ".bmp", ".sfv", ".htm", ".sh",
-    ".gif", ".zsh", ".swf", ".exe", ".inf", ".DS_Store", ".m3u8", ".to",
-]  # fmt: skip
-TO_COPY = [".ogg", ".cue", ".mp3", ".ogg"]
+    ".gif", ".zsh", ".swf", ".exe", ".inf", ".ds_store", ".m3u8", ".to",
+})  # fmt: skip
+TO_COPY = frozenset({".ogg", ".cue", ".mp3"})
 
+# OS and NAS metadata dirs, nothing in them is worth walking into
+SKIP_DIRS = frozenset({
+    ".Trashes", ".Spotlight-V100", ".fseventsd", ".TemporaryItems", "__MACOSX",
+    "@eaDir", "#recycle", "$RECYCLE.BIN", "System Volume Information",
+})  # fmt: skip
 
-def create_plan(source: pathlib.Path, dest: pathlib.Path, render: ui.Render):
-    if any(source.match(f) for f in IGNORED_GLOBS):
+# Containers that may already hold lossy audio, and so are worth probing
+MAYBE_LOSSY = frozenset({".m4a", ".mp4"})
+LOSSY_CODECS = frozenset({"aac", "mp3", "vorbis", "opus"})
+OGG_CODECS = frozenset({"vorbis", "opus"})
+
+
+class Options(NamedTuple):
+    threads_per_job: int = 1
+    remux: bool = False
+    cache: pathlib.Path | None = None
+
+
+class FoundFile(NamedTuple):
+    path: str
+    name: str
+    # Lowercased, worked out once here so the rest of the scan can reuse it
+    suffix: str
+    # Stat lazily, only files that end up with a plan need it. Not available when
+    # the listing came from the scan cache
+    dir_entry: os.DirEntry[str] | None
+
+
+def lower_suffix(name: str) -> str:
+    # Unlike Path.suffix this counts dotfiles (.DS_Store) as all suffix
+    dot = name.rfind(".")
+    return name[dot:].lower() if dot >= 0 else ""
+
+
+# dir path -> (dir mtime_ns, subdir names, file names)
+ScanCache = dict[str, tuple[int, list[str], list[str]]]
+# FAT/exFAT only keep mtimes to 2s, so a dir changed this close to the scan could
+# change again without its mtime moving. Listings that recent are never cached
+CACHE_SLACK_NS = 3 * 1_000_000_000
+
+
+# Pending ffprobe of a files codec, see create_plans
+CodecProbe = Future[str | None]
+
+PlanFactory = Callable[
+    [
+        pathlib.Path,
+        pathlib.Path,
+        str,
+        Progress,
+        Options,
+        os.stat_result | None,
+        CodecProbe | None,
+    ],
+    recode.Plan,
+]
+
+
+def needs_probe(suffix: str, options: Options) -> bool:
+    return options.remux and suffix in MAYBE_LOSSY
+
+
+def _make_ffmpeg(
+    source: pathlib.Path,
+    dest: pathlib.Path,
+    suffix: str,
+    progress: Progress,
+    options: Options,
+    src_stat: os.stat_result | None,
+    probe: CodecProbe | None,
+) -> recode.Plan:
+    if needs_probe(suffix, options):
+        # Recoding lossy to lossy only loses quality, so just move the audio over.
+        # Codecs ogg can hold go to .ogg like everything else.
+        codec = probe.result() if probe is not None else recode.probe_codec(source)
+        if codec in OGG_CODECS:
+            dest = dest.with_suffix(".ogg")
+        if codec in LOSSY_CODECS:
+            return recode.RemuxPlan(source, dest, progress, src_stat=src_stat)
+
+    return recode.FFMpegPlan(
+        source,
+        dest.with_suffix(".ogg"),
+        progress,
+        src_stat=src_stat,
+        threads=options.threads_per_job,
+    )
+
+
+def _make_copy(
+    source: pathlib.Path,
+    dest: pathlib.Path,
+    suffix: str,
+    progress: Progress,
+    options: Options,
+    src_stat: os.stat_result | None,
+    probe: CodecProbe | None,
+) -> recode.Plan:
+    return recode.CopyPlan(source, dest, progress, src_stat=src_stat)
+
+
+# None marks varied sometimes-inclided files that we dont need to copy
+_DISPATCH: dict[str, PlanFactory | None] = (
+    {ext: _make_ffmpeg for ext in TO_RECODE}
+    | {ext: _make_copy for ext in TO_COPY}
+    | {ext: None for ext in TO_SKIP}
+)
+
+
+def create_plan(
+    source: pathlib.Path,
+    dest: pathlib.Path,
+    render: ui.Render,
+    options: Options = Options(),
+    src_stat: os.stat_result | None = None,
+    suffix: str | None = None,
+    probe: CodecProbe | None = None,
+) -> recode.Plan | None:
+    if suffix is None:
+        suffix = lower_suffix(source.name)
+    if suffix not in _DISPATCH:
+        # return recode.CopyPlan(source, dest, render.task_progress)
+        print(f"Dont know how to handle {source}")
         return None
 
-    match source.suffix.lower():
-        case s if s in TO_RECODE:
-            return recode.FFMpegPlan(
-                source, dest.with_suffix(".ogg"), render.task_progress
-            )
-        case v if v in TO_COPY:
-            return recode.CopyPlan(source, dest, render.task_progress)
+    factory = _DISPATCH[suffix]
+    if factory is None:
+        return None
 
-        # Varied sometimes-inclided files that we dont need to copy
-        case v if v in TO_SKIP:
-            return None
+    return factory(source, dest, suffix, render.task_progress, options, src_stat, probe)
+
+
+def load_cache(path: pathlib.Path) -> ScanCache:
+    try:
+        with path.open("rb") as f:
+            return pickle.load(f)  # pyright: ignore[reportAny]
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+
+def save_cache(path: pathlib.Path, cache: ScanCache):
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        pickle.dump(cache, f)
+    os.replace(tmp, path)
 
-        case _:
-            # return recode.CopyPlan(source, dest, render.task_progress)
-            print(f"Dont know how to handle {source}")
-            return None
+
+def walk(
+    root: str, old_cache: ScanCache | None = None, new_cache: ScanCache | None = None
+) -> Iterator[FoundFile]:
+    # Stack based scandir walk, reuses DirEntry type info rather than restating.
+    # A dirs mtime only changes when entries are added or removed, so if it
+    # matches the cache we can reuse the old listing instead of reading it again
+    trust_before = time.time_ns() - CACHE_SLACK_NS
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        mtime = 0
+        if new_cache is not None:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError as e:
+                print(f"Skipping {path}: {e}")
+                continue
+
+            cached = old_cache.get(path) if old_cache is not None else None
+            if cached is not None and cached[0] == mtime:
+                new_cache[path] = cached
+                _, dirs, files = cached
+                stack.extend(os.path.join(path, name) for name in dirs)
+                for name in files:
+                    yield FoundFile(
+                        os.path.join(path, name), name, lower_suffix(name), None
+                    )
+                continue
+
+        dirs: list[str] = []
+        found: list[os.DirEntry[str]] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name in SKIP_DIRS:
+                            continue
+                        dirs.append(entry.name)
+                    # Linked dirs are never followed (no loops), linked tracks are
+                    elif entry.is_file():
+                        found.append(entry)
+        except OSError as e:
+            # Unreadable or vanished dirs shouldnt end the whole scan
+            print(f"Skipping {path}: {e}")
+            continue
+
+        stack.extend(os.path.join(path, name) for name in dirs)
+
+        # Inode order roughly follows on disk layout, which is kinder to readahead
+        # than whatever order the dir hands back. Cached listings keep this order
+        found.sort(key=lambda e: e.inode())
+        if new_cache is not None and mtime < trust_before:
+            new_cache[path] = (mtime, dirs, [e.name for e in found])
+
+        for entry in found:
+            yield FoundFile(entry.path, entry.name, lower_suffix(entry.name), entry)
 
 
 def create_plans(
-    source: pathlib.Path, dest: pathlib.Path, render: ui.Render
-) -> list[recode.Plan]:
+    source: pathlib.Path,
+    dest: pathlib.Path,
+    render: ui.Render,
+    options: Options = Options(),
+) -> Iterator[recode.Plan]:
     if not source.exists():
-        return []
+        return
 
-    out: list[recode.Plan] = []
+    selected = 0
+    # Plans expect their dest dir to exist, make each one once here rather than
+    # once per file (and racing) in the workers
+    dest_dirs: set[pathlib.Path] = set()
     task = render.total_progress.add_task(
         description="Processing... (Files Scanned / Files Selected)",
         total=None,
         start=True,
     )
-    for local_source in source.glob("**"):
-        if not local_source.is_file():
-            continue
+    old_cache = load_cache(options.cache) if options.cache is not None else None
+    new_cache: ScanCache | None = {} if options.cache is not None else None
 
-        render.total_progress.advance(task, 1)
-        if local_source.name == ".localized":
-            continue
+    # With --remux, probes are started as files are found and plans made a little
+    # behind, so ffprobe runs alongside the scan instead of in it
+    probe_ahead = (os.cpu_count() or 4) * 2
+    prober = ThreadPoolExecutor(max_workers=probe_ahead) if options.remux else None
+    pending: deque[tuple[FoundFile, CodecProbe | None]] = deque()
+
+    def finish(entry: FoundFile, probe: CodecProbe | None) -> recode.Plan | None:
+        src_stat = None
+        if entry.dir_entry is not None and entry.suffix in _DISPATCH:
+            src_stat = entry.dir_entry.stat()
 
+        local_source = pathlib.Path(entry.path)
         local_dest = dest / local_source.relative_to(source)
-        if (plan := create_plan(local_source, local_dest, render)) is not None:
-            out.append(plan)
+        plan = create_plan(
+            local_source,
+            local_dest,
+            render,
+            options,
+            src_stat,
+            entry.suffix,
+            probe,
+        )
+        if plan is None or plan.up_to_date():
+            return None
+
+        if (parent := plan.dest.parent) not in dest_dirs:
+            parent.mkdir(parents=True, exist_ok=True)
+            dest_dirs.add(parent)
+
+        return plan
+
+    try:
+        for entry in walk(os.fspath(source), old_cache, new_cache):
+            render.total_progress.advance(task, 1)
+            if entry.name in IGNORED_NAMES:
+                continue
+
+            if entry.suffix in _DISPATCH and _DISPATCH[entry.suffix] is None:
+                continue
 
-    render.total_progress.update(task, total=len(out))
-    return sorted(out, key=lambda v: v.source)
+            if prober is None:
+                plan = finish(entry, None)
+            else:
+                probe = None
+                if needs_probe(entry.suffix, options):
+                    probe = prober.submit(recode.probe_codec, pathlib.Path(entry.path))
+                pending.append((entry, probe))
+                plan = None
+                if len(pending) > probe_ahead:
+                    plan = finish(*pending.popleft())
 
+            if plan is not None:
+                selected += 1
+                yield plan
 
-def main(source: pathlib.Path, dest: pathlib.Path):
-    executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        while pending:
+            if (plan := finish(*pending.popleft())) is not None:
+                selected += 1
+                yield plan
+    finally:
+        if prober is not None:
+            prober.shutdown()
+
+    render.total_progress.update(task, total=selected)
+    if options.cache is not None and new_cache is not None:
+        save_cache(options.cache, new_cache)
+
+
+async def main(source: pathlib.Path, dest: pathlib.Path, options: Options = Options()):
+    # Keep jobs * threads per job at about the core count to avoid thrashing
+    workers = max(1, (os.cpu_count() or 4) // options.threads_per_job)
 
     render = ui.make_render()
 
+    loop = asyncio.get_running_loop()
+    # Bounded so the scanner stays only slightly ahead of the workers
+    plans: asyncio.Queue[recode.Plan | None] = asyncio.Queue(maxsize=workers * 2)
+    # Set once main is on its way out, nothing will read the queue after that
+    stop = threading.Event()
+
     with Live(render.table, refresh_per_second=10):
-        tasks: list[recode.Plan] = create_plans(source, dest, render)
-        total_task = render.total_progress.add_task("Files Processed", total=len(tasks))
+        total_task = render.total_progress.add_task("Files Processed", total=None)
 
-        def exec_worker(plan: recode.Plan):
-            plan.execute()
-            render.total_progress.advance(total_task, 1)
+        # Scanning is all blocking syscalls, so it gets a thread of its own
+        def produce():
+            def put(plan: recode.Plan | None):
+                fut = asyncio.run_coroutine_threadsafe(plans.put(plan), loop)
+                while not stop.is_set():
+                    try:
+                        fut.result(timeout=0.1)
+                        return
+                    except TimeoutError:
+                        pass
+                fut.cancel()
 
-        _ = list(executor.map(exec_worker, tasks))
+            count = 0
+            try:
+                for plan in create_plans(source, dest, render, options):
+                    if stop.is_set():
+                        return
+                    count += 1
+                    render.total_progress.update(total_task, total=count)
+                    put(plan)
+                render.total_progress.update(total_task, total=count)
+            finally:
+                for _ in range(workers):
+                    put(None)
+
+        async def exec_worker():
+            while (plan := await plans.get()) is not None:
+                try:
+                    await plan.execute()
+                except Exception as e:
+                    # One bad file shouldnt stop the rest of the library
+                    print(f"Failed... {plan.source}: {e!r}")
+                render.total_progress.advance(total_task, 1)
+
+        try:
+            await asyncio.gather(
+                asyncio.to_thread(produce), *(exec_worker() for _ in range(workers))
+            )
+        finally:
+            stop.set()
 
 
 if __name__ == "__main__":
@@ -101,7 +394,36 @@ if __name__ == "__main__":
         required=True,
         help="Dest of media files",
     )
+    parser.add_argument(
+        "--threads-per-job",
+        "-t",
+        type=int,
+        default=1,
+        help="Threads given to each ffmpeg job, fewer jobs are run in parallel",
+    )
+    parser.add_argument(
+        "--remux",
+        action="store_true",
+        help="Remux already lossy audio instead of recoding it",
+    )
+    parser.add_argument(
+        "--cache",
+        "-c",
+        type=pathlib.Path,
+        default=None,
+        help="File to cache the source scan in, speeds up rescans of slow drives",
+    )
 
     parsed = parser.parse_args()
 
-    main(parsed.source_path, parsed.dest_path)
+    asyncio.run(
+        main(
+            parsed.source_path,
+            parsed.dest_path,
+            Options(
+                threads_per_job=max(1, parsed.threads_per_job),
+                remux=parsed.remux,
+                cache=parsed.cache,
+            ),
+        )
+    )
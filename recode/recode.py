@@ -1,15 +1,14 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import os
 import pathlib
+import re
 import shutil
 import subprocess
-import threading
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from functools import cached_property
-from io import TextIOWrapper
-from typing import TYPE_CHECKING, ClassVar, TypedDict, override
+from typing import ClassVar, override
 
 from rich import print
 from rich.progress import (
@@ -17,18 +16,33 @@ from rich.progress import (
     TaskID,
 )
 
-if TYPE_CHECKING:
-
-    class FFProbeFormat(TypedDict):
-        filename: str
-        start_time: str
-        duration: str
-        size: str
-        bit_rate: str
-        tags: dict[str, str]
-
-    class FFProbeOutput(TypedDict):
-        format: FFProbeFormat
+# Only used when copyfile cant use the kernel fast path (sendfile and friends)
+# Not in the typeshed stubs, but setting it is deliberate
+shutil.COPY_BUFSIZE = 4 * 1024 * 1024  # pyright: ignore[reportAttributeAccessIssue]
+
+
+def probe_codec(source: pathlib.Path) -> str | None:
+    res = subprocess.run(
+        [
+            "ffprobe",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=codec_name",
+            "-output_format",
+            "default=noprint_wrappers=1:nokey=1",
+            source.absolute().as_posix(),
+        ],
+        capture_output=True,
+        text=True,
+    )
+
+    if res.returncode != 0:
+        return None
+    return res.stdout.strip() or None
 
 
 @dataclass
@@ -39,37 +53,55 @@ class Plan(ABC):
     task_id: TaskID = field(init=False)
 
     type: str = "Unknown"
+    # Stat from the scan, saves restating the source later
+    src_stat: os.stat_result | None = None
 
-    def __post_init__(self):
+    @property
+    def partial_dest(self) -> pathlib.Path:
+        # Keeps the real suffix last so ffmpeg can still pick the output format
+        return self.dest.with_name(f"{self.dest.stem}.part{self.dest.suffix}")
+
+    def up_to_date(self) -> bool:
+        # Outputs are only ever moved into place once complete, so an existing one
+        # that is newer than its source is already done
+        try:
+            dest_stat = self.dest.stat()
+        except FileNotFoundError:
+            return False
+
+        src_stat = self.src_stat or self.source.stat()
+        return dest_stat.st_mtime >= src_stat.st_mtime
+
+    # Tasks only exist while the plan runs, rich renders every task it knows of
+    def start_task(self):
         self.task_id = self.progress.add_task(
             description=self.source.name,
-            start=False,
-            visible=False,
             operation_type=self.type,
         )
 
-    def start_task(self):
-        self.progress.start_task(self.task_id)
-        self.progress.update(self.task_id, visible=True)
-
     def completed(self):
-        self.progress.update(self.task_id, visible=False)
+        self.progress.remove_task(self.task_id)
 
     @abstractmethod
-    def _execute(self): ...
+    async def _execute(self): ...
 
-    def execute(self) -> None:
+    async def execute(self) -> None:
         self.start_task()
-        self._execute()
-        self.completed()
+        try:
+            await self._execute()
+        finally:
+            self.completed()
 
 
 @dataclass
 class FFMpegPlan(Plan):
     DEFAULT_FLAGS: ClassVar[list[str]] = [
         "-hide_banner",
+        "-nostats",
+        # info level gets us the input header (tags, duration) without an ffprobe
+        # run, and the level prefix lets us tell it apart from actual warnings
         "-loglevel",
-        "warning",
+        "level+info",
         "-progress",
         "pipe:1",
         "-stats_period",
@@ -77,71 +109,79 @@ class FFMpegPlan(Plan):
         "-y",
         "-vn",
     ]
+    READ_SIZE: ClassVar[int] = 1 << 16
+
+    LOG_LEVEL: ClassVar[re.Pattern[str]] = re.compile(
+        r"\[(trace|debug|verbose|info|warning|error|fatal|panic)\] ?"
+    )
+    HEADER_LEVELS: ClassVar[frozenset[str]] = frozenset(
+        {"trace", "debug", "verbose", "info"}
+    )
+    HEADER_DURATION: ClassVar[re.Pattern[str]] = re.compile(
+        r"^  Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)"
+    )
+    HEADER_TAG: ClassVar[re.Pattern[str]] = re.compile(r"^    (\S[^:]*?)\s*: (.*)$")
 
-    FFPROBE_FLAGS: ClassVar[list[str]] = [
-        "-output_format",
-        "json",
-        "-show_format",
-        "-hide_banner",
-        "-loglevel",
-        "warning",
-    ]
     type: str = "File Recode"
+    # Each plan runs alongside others, so keep ffmpeg from using every core
+    threads: int = 1
 
     progress_us: int = field(init=False, default=0)
-
-    @cached_property
-    def file_info(self) -> FFProbeOutput:
-        res = subprocess.run(
-            [
-                "ffprobe",
-                *self.FFPROBE_FLAGS,
-                self.source.absolute().as_posix(),
-            ],
-            capture_output=True,
-        )
-
-        res.check_returncode()
-        return json.loads(res.stdout)  # pyright: ignore[reportAny]
-
-    @cached_property
-    def format(self) -> FFProbeFormat:
-        return self.file_info["format"]
-
-    @cached_property
-    def size(self) -> int:
-        return int(self.format["size"])
-
-    @cached_property
-    def duration(self) -> float:
-        return float(self.format["duration"]) * 1_000_000
-
-    @cached_property
-    def tags(self) -> dict[str, str]:
-        return self.format["tags"]
+    duration: float | None = field(init=False, default=None)
+    tags: dict[str, str] = field(init=False, default_factory=dict[str, str])
+    _in_input_header: bool = field(init=False, default=False)
 
     @property
     def ffmpeg_args(self):
         return [
             "-i",
             self.source.absolute().as_posix(),
-            self.dest.absolute().as_posix(),
+            "-threads",
+            str(self.threads),
+            self.partial_dest.absolute().as_posix(),
         ]
 
-    def _handle_state_update(self, line: str):
-        key, _, value = line.strip().partition("=")
-        match key:
-            case "out_time_us":
-                if value.isdecimal():
-                    self.progress_us = int(value)
-                    self.progress.update(self.task_id, completed=self.progress_us)
-                elif value != "N/A":
-                    self.progress.print(f"Invalid value for out time {value = !r}")
-            case _:
-                pass
-
-    @override
-    def start_task(self):
+    def _handle_state_update(self, lines: list[bytes]):
+        # Only the latest out time matters, the UI wont redraw between them anyway
+        value = None
+        for line in lines:
+            key, _, v = line.strip().partition(b"=")
+            if key == b"out_time_us":
+                value = v
+
+        if value is None:
+            return
+
+        if value.isdigit():
+            self.progress_us = int(value)
+            self.progress.update(self.task_id, completed=self.progress_us)
+        elif value != b"N/A":
+            self.progress.print(f"Invalid value for out time {value = !r}")
+
+    def _handle_header_line(self, line: str):
+        if line.startswith("Input #"):
+            self._in_input_header = True
+            return
+
+        if line.startswith("Output #"):
+            self._in_input_header = False
+            return
+
+        if not self._in_input_header:
+            return
+
+        if (m := self.HEADER_DURATION.match(line)) is not None:
+            hours, minutes, seconds = m.groups()
+            self.duration = (
+                int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            ) * 1_000_000
+            # Tags come before duration in the header, so we have everything now
+            self._update_description()
+
+        elif (m := self.HEADER_TAG.match(line)) is not None:
+            _ = self.tags.setdefault(m.group(1).upper(), m.group(2))
+
+    def _update_description(self):
         track_name = self.tags.get("TITLE", self.source.name)
         track_album = self.tags.get("ALBUM", "UAL")
         track_artist = self.tags.get("ARTIST", "UA")
@@ -150,37 +190,70 @@ class FFMpegPlan(Plan):
             description=f"{track_artist!r} - {track_album!r}: {track_name!r}",
             total=self.duration,
         )
-        super().start_task()
 
-    def _stderr_print(self, stderr: TextIOWrapper):
-        for line in iter(stderr.readline, ""):
+    async def _stderr_print(self, stderr: asyncio.StreamReader):
+        async for raw in stderr:
+            line = raw.decode(errors="replace").rstrip("\n")
+            m = self.LOG_LEVEL.search(line)
+            if m is not None and m.group(1) in self.HEADER_LEVELS:
+                self._handle_header_line(line[m.end() :])
+                continue
+
+            # ffmpeg context and level prefixes look like rich markup
             self.progress.print(
-                f"Stderr from {self.tags.get('TITLE', self.source)}: {line!r}"
+                f"Stderr from {self.tags.get('TITLE', self.source)}: {line!r}",
+                markup=False,
             )
 
     @override
-    def _execute(self):
-        self.dest.parent.mkdir(parents=True, exist_ok=True)
-        proc = subprocess.Popen(
-            ["ffmpeg", *self.DEFAULT_FLAGS, *self.ffmpeg_args],
+    async def _execute(self):
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            *self.DEFAULT_FLAGS,
+            *self.ffmpeg_args,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
         )
         assert proc.stdout is not None
         assert proc.stderr is not None
 
-        threading.Thread(
-            daemon=True, target=self._stderr_print, args=(proc.stderr,)
-        ).start()
+        stderr_task = asyncio.create_task(self._stderr_print(proc.stderr))
+
+        # Read whatever is available in one go rather than waking up per line
+        line = b""
+        pending = b""
+        while chunk := await proc.stdout.read(self.READ_SIZE):
+            *lines, pending = (pending + chunk).split(b"\n")
+            if lines:
+                line = lines[-1]
+                self._handle_state_update(lines)
 
-        line = ""
-        for line in iter(proc.stdout.readline, ""):
-            self._handle_state_update(line)
-        while proc.poll() is None:
-            ...
+        await stderr_task
+        await proc.wait()
         if proc.returncode != 0:
-            print(f"Failed... {proc.returncode}, {line!r}")
+            print(f"Failed... {proc.returncode}, {line.decode(errors='replace')!r}")
+            self.partial_dest.unlink(missing_ok=True)
+            return
+
+        os.replace(self.partial_dest, self.dest)
+
+
+@dataclass
+class RemuxPlan(FFMpegPlan):
+    type: str = "File Remux"
+
+    @property
+    @override
+    def ffmpeg_args(self):
+        return [
+            "-i",
+            self.source.absolute().as_posix(),
+            "-map",
+            "0:a",
+            "-c:a",
+            "copy",
+            self.partial_dest.absolute().as_posix(),
+        ]
 
 
 @dataclass
@@ -188,6 +261,21 @@ class CopyPlan(Plan):
     type: str = "File Copy"
 
     @override
-    def _execute(self):
-        self.dest.parent.mkdir(exist_ok=True, parents=True)
-        _ = shutil.copy(self.source, self.dest)
+    def start_task(self):
+        super().start_task()
+        if self.src_stat is not None:
+            self.progress.update(self.task_id, total=self.src_stat.st_size)
+
+    @override
+    async def _execute(self):
+        # copyfile skips the chmod that copy does and takes the in kernel fast path
+        try:
+            _ = await asyncio.to_thread(shutil.copyfile, self.source, self.partial_dest)
+        except BaseException:
+            # The partial keeps the real suffix, dont leave it for players to find
+            self.partial_dest.unlink(missing_ok=True)
+            raise
+
+        os.replace(self.partial_dest, self.dest)
+        if self.src_stat is not None:
+            self.progress.update(self.task_id, completed=self.src_stat.st_size)